@@ -1,12 +1,28 @@
 import argparse
 import os
+import time
+
+from collections import Counter
+from typing import Optional
+
+import orjson
 
 from devtools import pprint
 from magentic import OpenaiChatModel, prompt
+from magentic.chat_model.function_schema import function_schema_for_type
+from magentic.chat_model.openai_chat_model import FunctionToolSchema
+from openai import OpenAI
+from pydantic import ValidationError
 
 from autoproject import functions
 from autoproject.models import Project
 
+BATCH_POLL_INTERVAL = 30
+FUNCTION_LIST = "\n".join(
+    f"- {name}: {description}"
+    for name, description in functions.get_function_list().items()
+)
+
 
 @prompt(
     """
@@ -16,7 +32,8 @@ Create unique assistants with roles, skills and backstory necessary to complete
 Create a number of assistants with efficiency in mind, do not create more assistants than tasks.
 The backstory must be written as if speaking to that assistant (it will be a prompt for an LLM).
 Assign tasks to assistants with efficiency in mind.
-These are the functions that can be used by tasks: {function_list}
+These are the functions that can be used by tasks:
+{function_list}
 If the task will require external resources or API functions that you cannot provide,
 list them as requirements for the project.
 When thinking about requirements, be aware that you are an LLM without access to
@@ -25,7 +42,114 @@ with the project and Internet.
 """
 )
 # pylint: disable=unused-argument, missing-function-docstring
-def create_project(goals: list[str], function_list: dict) -> Project: ...
+def create_project(goals: list[str], function_list: str) -> Project: ...
+
+
+def batch_create_projects(
+    goals_list: list[list[str]],
+) -> list[tuple[str, Project]]:
+    """
+    Create a project plan for each list of goals using the OpenAI Batch API.
+    Each project is returned with the custom_id of its request.
+    """
+    client = OpenAI()
+    schema = function_schema_for_type(Project)
+
+    batch_requests = [
+        {
+            "custom_id": f"project-{index}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": os.getenv("PLANNER_MODEL", "gpt-4o"),
+                "temperature": float(os.getenv("PLANNER_TEMPERATURE", "0.2")),
+                "messages": [
+                    {
+                        "role": "user",
+                        "content": create_project.format(
+                            goals, function_list=FUNCTION_LIST
+                        ),
+                    }
+                ],
+                "tools": [FunctionToolSchema(schema).to_dict()],
+                "tool_choice": {"type": "function", "function": {"name": schema.name}},
+            },
+        }
+        for index, goals in enumerate(goals_list)
+    ]
+
+    content = b"\n".join(orjson.dumps(request) for request in batch_requests)
+    batch_file = client.files.create(
+        file=("projects.jsonl", content),
+        purpose="batch",
+    )
+    batch = client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+
+    while batch.status not in ["completed", "failed", "expired", "cancelled"]:
+        print(f"Waiting on batch {batch.id} ({batch.status})")
+        time.sleep(BATCH_POLL_INTERVAL)
+        batch = client.batches.retrieve(batch.id)
+
+    if batch.status != "completed":
+        raise RuntimeError(f"Batch {batch.id} did not complete: {batch.status}")
+
+    if batch.error_file_id:
+        for line in client.files.content(batch.error_file_id).text.splitlines():
+            result = orjson.loads(line)
+            print(f"Request {result['custom_id']} failed: {batch_error(result)}")
+
+    if not batch.output_file_id:
+        print(f"Batch {batch.id} has no successful requests")
+        return []
+
+    projects = {}
+
+    for line in client.files.content(batch.output_file_id).text.splitlines():
+        result = orjson.loads(line)
+        response = result["response"]
+
+        if not response or response["status_code"] != 200:
+            print(f"Request {result['custom_id']} failed: {batch_error(result)}")
+            continue
+
+        message = response["body"]["choices"][0]["message"]
+
+        if not message.get("tool_calls"):
+            reason = message.get("refusal") or message.get("content")
+            print(f"Request {result['custom_id']} returned no project: {reason}")
+            continue
+
+        arguments = message["tool_calls"][0]["function"]["arguments"]
+
+        try:
+            projects[result["custom_id"]] = Project.model_validate_json(arguments)
+        except ValidationError as error:
+            print(f"Request {result['custom_id']} returned an invalid project: {error}")
+
+    # References are written by the model, keep them unique within the sweep
+    references = Counter(project.reference for project in projects.values())
+    for custom_id, project in projects.items():
+        if references[project.reference] > 1:
+            project.reference = f"{project.reference}-{custom_id}"
+
+    return [
+        (request["custom_id"], projects[request["custom_id"]])
+        for request in batch_requests
+        if request["custom_id"] in projects
+    ]
+
+
+def batch_error(result: dict) -> Optional[dict]:
+    """Get the error of a failed request from a batch output or error file."""
+    if result.get("error"):
+        return result["error"]
+
+    response = result.get("response") or {}
+    return response.get("body", {}).get("error")
 
 
 def main():
@@ -33,12 +157,34 @@ def main():
     parser = argparse.ArgumentParser(description="Create a project plan.")
     parser.add_argument("-l", "--load", help="Load a project from a file.")
     parser.add_argument(
-        "-s", "--save", help="Save the project to a file before execution."
+        "-s", "--save", help="Save the project to a file before and after execution."
+    )
+    parser.add_argument(
+        "-i",
+        "--interactive",
+        action="store_true",
+        help="Wait for confirmation after each task is done.",
+    )
+    parser.add_argument(
+        "-b",
+        "--batch",
+        help="Create a project plan for each list of goals in a JSON file "
+        + "using the OpenAI Batch API, saving them without execution.",
     )
     parser.add_argument("goals", nargs="*", help="The goals for the project.")
 
     args = parser.parse_args()
 
+    if args.batch:
+        with open(args.batch, "rb") as file:
+            goals_list = orjson.loads(file.read())
+
+        for custom_id, project in batch_create_projects(goals_list):
+            print(f"Saving project to projects/{custom_id}.json")
+            project.save(f"projects/{custom_id}.json")
+
+        return
+
     if args.load:
         print(f"Loading project from projects/{args.load}.json")
         project = Project.load(f"projects/{args.load}.json")
@@ -47,9 +193,7 @@ def main():
             os.getenv("PLANNER_MODEL", "gpt-4o"),
             temperature=float(os.getenv("PLANNER_TEMPERATURE", "0.2")),
         ):
-            project = create_project(
-                args.goals, function_list=functions.get_function_list()
-            )
+            project = create_project(args.goals, function_list=FUNCTION_LIST)
 
             if args.save:
                 print(f"Saving project to projects/{args.save}.json")
@@ -57,7 +201,13 @@ def main():
 
     pprint(project)
 
-    project.execute()
+    try:
+        project.execute(interactive=args.interactive)
+    finally:
+        if args.save or args.load:
+            print(f"Saving project to projects/{args.save or args.load}.json")
+            project.save(f"projects/{args.save or args.load}.json")
+
     print("All tasks are done!")
 
 
@@ -1,16 +1,34 @@
+import asyncio
+import functools
+import hashlib
+import io
 import os
 
-import requests
+from typing import Iterable, Iterator, Optional
 
+import httpx
+
+from aiolimiter import AsyncLimiter
+from diskcache import Cache
 from html_meta_data_parse import HtmlMetaDataParse
 from PIL import Image
-from playwright.sync_api import sync_playwright
+from playwright.async_api import Browser, Playwright, async_playwright
 from pydantic import BaseModel
 from slugify import slugify
 from unstructured.partition.html import partition_html
 
 
 MAX_IMAGE_SIZE = (2000, 768)
+SCREENSHOT_QUALITY = 85
+CHUNK_SIZE = 8000
+CACHE_EXPIRE = 3600
+SEARCH_URL = "https://google.serper.dev/search"
+
+_PLAYWRIGHT: Optional[Playwright] = None
+_BROWSER: Optional[Browser] = None
+_BROWSER_LOCK: Optional[asyncio.Lock] = None
+_SEARCH_LIMITER = AsyncLimiter(250, 60)
+_HTTP_CLIENT: Optional[httpx.AsyncClient] = None
 
 
 def get_function_list() -> dict:
@@ -18,8 +36,10 @@ def get_function_list() -> dict:
     return {
         "page_metadata": "Fetches metadata from a URL.",
         "page_screenshot": "Creates a screenshot of a URL.",
+        "page_screenshot_batch": "Creates screenshots of a list of URLs.",
         "page_scrape": "Scrapes the content of a URL.",
         "search_internet": "Searches the internet for a given query.",
+        "search_internet_batch": "Searches the internet for a list of queries.",
     }
 
 
@@ -36,8 +56,16 @@ class PageMetadata(BaseModel):
     type: str
 
 
-def page_metadata(url: str) -> PageMetadata:
+def page_metadata(url: str, skip_cache: bool = False) -> PageMetadata:
     """Fetches metadata from a URL."""
+    cache = _get_cache()
+    key = _cache_key("page_metadata", url)
+
+    if not skip_cache:
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
     html_meta_data_parse = HtmlMetaDataParse()
     attributes = html_meta_data_parse.get_meta_data_by_url(url)
 
@@ -47,58 +75,206 @@ def page_metadata(url: str) -> PageMetadata:
     for attribute in unneeded_attributes:
         attributes.pop(attribute, None)
 
+    cache.set(key, attributes, expire=CACHE_EXPIRE)
+
     return attributes
 
 
-def page_screenshot(url: str) -> str:
+async def page_screenshot(url: str) -> str:
     """Creates a screenshot of a URL."""
-    attributes = page_metadata(url)
-    filename = slugify(attributes.get("site_name") or attributes.get("title")) + ".png"
+    return await _screenshot(await _get_browser(), url)
+
+
+async def page_screenshot_batch(urls: list[str]) -> list[str]:
+    """Creates screenshots of a list of URLs."""
+    browser = await _get_browser()
+    unique_urls = list(dict.fromkeys(urls))
+    screenshots = await asyncio.gather(
+        *[_screenshot(browser, url) for url in unique_urls]
+    )
+    paths = dict(zip(unique_urls, screenshots))
+    return [paths[url] for url in urls]
+
+
+async def _screenshot(browser: Browser, url: str) -> str:
+    """Creates a screenshot of a URL in its own browser context."""
+    attributes = await asyncio.to_thread(page_metadata, url)
+    name = slugify(attributes.get("site_name") or attributes.get("title"))
+    filename = f"{name}-{_url_hash(url)[:16]}.jpg"
     screenshot = f"storage/screenshots/{filename}"
 
-    with sync_playwright() as p:
-        browser = p.chromium.launch()
-        page = browser.new_page()
-        page.goto(url)
-        page.screenshot(path=screenshot, full_page=True)
-        browser.close()
+    context = await browser.new_context()
+    try:
+        page = await context.new_page()
+        await page.goto(url)
+        data = await page.screenshot(
+            full_page=True, type="jpeg", quality=SCREENSHOT_QUALITY
+        )
+    finally:
+        await context.close()
+
+    await asyncio.to_thread(_save_thumbnail, data, screenshot)
+
+    return screenshot
+
 
-    image = Image.open(screenshot)
+def _save_thumbnail(data: bytes, filename: str) -> None:
+    """Shrinks a JPEG screenshot to fit the maximum image size and saves it."""
+    image = Image.open(io.BytesIO(data))
     width, height = image.size
     if width > height:
         fit_size = MAX_IMAGE_SIZE
     else:
-        fit_size = list(reversed(MAX_IMAGE_SIZE))
-    image.thumbnail(fit_size)
-    image.save(screenshot)
-
-    return screenshot
+        fit_size = tuple(reversed(MAX_IMAGE_SIZE))
+    image.draft("RGB", fit_size)
+    image.thumbnail(fit_size, resample=Image.Resampling.BILINEAR)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    image.save(filename, quality=SCREENSHOT_QUALITY, optimize=True)
 
 
-def page_scrape(url: str) -> str:
+async def page_scrape(url: str, skip_cache: bool = False) -> list[str]:
     """Scrapes the content of a URL."""
-    with sync_playwright() as p:
-        browser = p.chromium.launch()
-        page = browser.new_page()
-        page.goto(url)
-        text = page.content()
-        browser.close()
+    cache = _get_cache()
+    key = _cache_key("page_scrape", url)
+
+    if not skip_cache:
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
+    browser = await _get_browser()
+    page = await browser.new_page()
+    try:
+        await page.goto(url)
+        text = await page.content()
+    finally:
+        await page.close()
 
-    elements = partition_html(text=text)
+    elements = await asyncio.to_thread(partition_html, text=text)
 
-    content = "\n\n".join([str(el) for el in elements])
-    content = [content[i : i + 8000] for i in range(0, len(content), 8000)]
+    content = list(_iter_chunks(elements))
+
+    cache.set(key, content, expire=CACHE_EXPIRE)
 
     return content
 
 
-def search_internet(query: str, n_results: int = 5) -> dict:
+def _iter_chunks(elements: Iterable, size: int = CHUNK_SIZE) -> Iterator[str]:
+    """Yields the text of partitioned elements in chunks of at most size characters."""
+    buffer = io.StringIO()
+    length = 0
+    separator = ""
+
+    for element in elements:
+        text = separator + str(element)
+        separator = "\n\n"
+
+        while length + len(text) >= size:
+            buffer.write(text[: size - length])
+            yield buffer.getvalue()
+            text = text[size - length :]
+            buffer = io.StringIO()
+            length = 0
+
+        buffer.write(text)
+        length += len(text)
+
+    if length:
+        yield buffer.getvalue()
+
+
+@functools.cache
+def _get_cache() -> Cache:
+    """Get the on-disk cache for fetched pages."""
+    return Cache("storage/cache")
+
+
+def _cache_key(function: str, url: str) -> str:
+    """Generate a cache key for a function call on a URL."""
+    return f"{function}:{_url_hash(url)}"
+
+
+def _url_hash(url: str) -> str:
+    """Generate a hash of a URL."""
+    return hashlib.blake2b(url.encode("utf-8")).hexdigest()
+
+
+async def _get_browser() -> Browser:
+    """Get the shared browser, launching it on first use."""
+    global _PLAYWRIGHT, _BROWSER, _BROWSER_LOCK  # pylint: disable=global-statement
+
+    if _BROWSER_LOCK is None:
+        _BROWSER_LOCK = asyncio.Lock()
+
+    async with _BROWSER_LOCK:
+        if _BROWSER is None or not _BROWSER.is_connected():
+            await _close_browser()
+            _PLAYWRIGHT = await async_playwright().start()
+            _BROWSER = await _PLAYWRIGHT.chromium.launch()
+
+    return _BROWSER
+
+
+async def _close_browser() -> None:
+    """Close the shared browser and stop Playwright."""
+    global _PLAYWRIGHT, _BROWSER  # pylint: disable=global-statement
+
+    if _BROWSER is not None:
+        if _BROWSER.is_connected():
+            await _BROWSER.close()
+        _BROWSER = None
+
+    if _PLAYWRIGHT is not None:
+        await _PLAYWRIGHT.stop()
+        _PLAYWRIGHT = None
+
+
+async def shutdown() -> None:
+    """Releases the shared resources used by the functions."""
+    global _HTTP_CLIENT, _BROWSER_LOCK  # pylint: disable=global-statement
+
+    if _HTTP_CLIENT is not None:
+        await _HTTP_CLIENT.aclose()
+        _HTTP_CLIENT = None
+
+    await _close_browser()
+    _BROWSER_LOCK = None
+
+
+async def search_internet(query: str, n_results: int = 5) -> dict:
     """Searches the internet for a given query."""
-    return requests.post(
-        "https://google.serper.dev/search",
-        headers={
-            "X-API-KEY": os.environ["SERPER_API_KEY"],
-        },
-        json={"q": query, "num": n_results},
-        timeout=(3, 27),
-    ).json()
+    async with _SEARCH_LIMITER:
+        response = await _get_http_client().post(
+            SEARCH_URL,
+            headers={
+                "X-API-KEY": os.environ["SERPER_API_KEY"],
+            },
+            json={"q": query, "num": n_results},
+        )
+
+    return response.json()
+
+
+async def search_internet_batch(queries: list[str], n_results: int = 5) -> list[dict]:
+    """Searches the internet for a list of queries."""
+    semaphore = asyncio.Semaphore(10)
+
+    async def search(query: str) -> dict:
+        async with semaphore:
+            return await search_internet(query, n_results)
+
+    return list(await asyncio.gather(*[search(query) for query in queries]))
+
+
+def _get_http_client() -> httpx.AsyncClient:
+    """Get the shared HTTP client, creating it on first use."""
+    global _HTTP_CLIENT  # pylint: disable=global-statement
+
+    if _HTTP_CLIENT is None or _HTTP_CLIENT.is_closed:
+        _HTTP_CLIENT = httpx.AsyncClient(
+            http2=True,
+            timeout=httpx.Timeout(27, connect=3),
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+        )
+
+    return _HTTP_CLIENT
@@ -1,15 +1,70 @@
-import json
+import asyncio
+import functools
+import inspect
 import os
-import time
 
-from typing import Optional
+from collections import deque
+from typing import Any, Iterable, Optional
 
-from openai import OpenAI
+import orjson
+
+from openai import AsyncOpenAI, BadRequestError, NotFoundError, RateLimitError
 from magentic.chat_model.function_schema import FunctionCallFunctionSchema
 from magentic.chat_model.openai_chat_model import FunctionToolSchema
-from pydantic import BaseModel, PrivateAttr
+from pydantic import BaseModel, PrivateAttr, model_validator
+from tenacity import (
+    retry,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_exponential_jitter,
+)
 
 from autoproject import functions as available_functions
+from autoproject.ratelimit import RateLimiter
+
+RUN_STOP_EVENTS = [
+    "thread.run.requires_action",
+    "thread.run.completed",
+    "thread.run.incomplete",
+    "thread.run.failed",
+    "thread.run.cancelled",
+    "thread.run.expired",
+]
+
+TASK_RESULTS_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "task_results",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "results": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "custom_id": {"type": "string"},
+                            "result": {"type": "string"},
+                        },
+                        "required": ["custom_id", "result"],
+                        "additionalProperties": False,
+                    },
+                }
+            },
+            "required": ["results"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _tool_schemas_for(names: tuple[str, ...]) -> tuple[dict, ...]:
+    """Generate the tool schemas for a set of available functions."""
+    functions = [getattr(available_functions, name) for name in names]
+    function_schemas = [FunctionCallFunctionSchema(f) for f in functions]
+    return tuple(FunctionToolSchema(schema).to_dict() for schema in function_schemas)
 
 
 class Assistant(BaseModel):
@@ -19,6 +74,7 @@ class Assistant(BaseModel):
     role: str
     instructions: str
     tools: list[str] = []
+    id: Optional[str] = None
 
 
 class Requirement(BaseModel):
@@ -38,6 +94,7 @@ class Task(BaseModel):
     instructions: str
     assigned_to: Assistant
     done: bool = False
+    result: Optional[str] = None
     depends_on: list[str] = []
     functions: list[str] = []
 
@@ -51,140 +108,414 @@ class Project(BaseModel):
     tasks: list[Task]
     requirements: list[Requirement] = []
 
-    _client: Optional[OpenAI] = PrivateAttr(None)
+    _client: Optional[AsyncOpenAI] = PrivateAttr(None)
+    _semaphore: Optional[asyncio.Semaphore] = PrivateAttr(None)
+    _limiter: Optional[RateLimiter] = PrivateAttr(None)
+    _assistant_index: dict[str, Any] = PrivateAttr(default_factory=dict)
+    _interactive: bool = PrivateAttr(False)
+    _input_lock: Optional[asyncio.Lock] = PrivateAttr(None)
+    _waves: list[list[Task]] = PrivateAttr(default_factory=list)
+    _dependents: dict[str, list[str]] = PrivateAttr(default_factory=dict)
+
+    @model_validator(mode="after")
+    def link_assistants(self) -> "Project":
+        """Share the project's assistant models with the tasks assigned to them."""
+        assistants = {assistant.name: assistant for assistant in self.assistants}
+        for task in self.tasks:
+            task.assigned_to = assistants.get(task.assigned_to.name, task.assigned_to)
+        return self
+
+    def execute(
+        self, client: Optional[AsyncOpenAI] = None, interactive: bool = False
+    ) -> None:
+        """
+        Execute the project.
+        When interactive, wait for the user to confirm each completed task.
+        """
+        self._interactive = interactive
+        asyncio.run(self._aexecute(client))
+
+    async def _aexecute(self, client: Optional[AsyncOpenAI] = None) -> None:
+        """Execute the project on the running event loop."""
+        try:
+            await self._run(client)
+        finally:
+            await available_functions.shutdown()
+
+    async def _run(self, client: Optional[AsyncOpenAI] = None) -> None:
+        """Create the assistants and run the tasks in dependency order."""
+        self._waves = self._topo()
 
-    def execute(self, client: Optional[OpenAI] = None) -> None:
-        """Execute the project."""
         if not client:
-            client = OpenAI()
+            client = AsyncOpenAI()
 
         self._client = client
+        self._semaphore = asyncio.Semaphore(int(os.getenv("OPENAI_CONCURRENCY", "8")))
+        self._limiter = RateLimiter.from_env()
+        self._input_lock = asyncio.Lock()
+        if not all(assistant.id for assistant in self.assistants):
+            self._assistant_index = {
+                assistant.name: assistant
+                for assistant in await self.get_assistant_list()
+            }
+
+        for task in self.tasks:
+            self.generate_tool_schemas(task.functions)
+
+        await asyncio.gather(
+            *[self._aupsert(assistant) for assistant in self.assistants]
+        )
 
-        for assistant in self.assistants:
-            print(
-                f"Creating/updating assistant {assistant.name} with role "
-                + f"{assistant.role} for project {self.reference}."
+        tasks = dict((task.title, task) for task in self.tasks)
+        indeg = {
+            task.title: sum(
+                1 for depend_on in task.depends_on if not tasks[depend_on].done
             )
-            self.update_or_create_assistant(assistant)
+            for task in self.tasks
+        }
 
-        thread = client.beta.threads.create()
+        ready = deque(
+            task
+            for wave in self._waves
+            for task in wave
+            if not task.done and indeg[task.title] == 0
+        )
 
-        done_count = 0
-        tasks = dict((task.title, task) for task in self.tasks)
+        running = {}
+        error = None
 
-        while done_count < len(tasks):
-            for task in tasks.values():
-                if task.done:
+        # After a failure, stop dispatching but let the running tasks finish
+        while (ready and not error) or running:
+            batches = {}
+            while ready and not error:
+                task = ready.popleft()
+                batches.setdefault(task.assigned_to.name, []).append(task)
+
+            for batch in batches.values():
+                running[asyncio.create_task(self._run_tasks(batch, tasks))] = batch
+
+            finished, _ = await asyncio.wait(
+                running, return_when=asyncio.FIRST_COMPLETED
+            )
+
+            for future in finished:
+                batch = running.pop(future)
+
+                if future.exception():
+                    error = error or future.exception()
                     continue
-                if all(tasks[depend_on].done for depend_on in task.depends_on):
-                    print(f"{task.assigned_to.role}: {task.instructions}")
 
-                    client.beta.threads.messages.create(
-                        thread_id=thread.id,
-                        role="user",
-                        content=task.instructions,
+                for task in batch:
+                    for child in self._dependents[task.title]:
+                        indeg[child] -= 1
+                        if indeg[child] == 0 and not tasks[child].done:
+                            ready.append(tasks[child])
+
+        if error:
+            raise error
+
+    def _topo(self) -> list[list[Task]]:
+        """
+        Validate the tasks and sort them into waves using Kahn's algorithm.
+        Each wave only depends on the waves before it.
+        """
+        tasks = {}
+        for task in self.tasks:
+            if task.title in tasks:
+                raise ValueError(f"Task '{task.title}' is defined more than once.")
+            tasks[task.title] = task
+
+        assistants = {assistant.name for assistant in self.assistants}
+        indeg = {}
+        self._dependents = dict((title, []) for title in tasks)
+
+        for task in self.tasks:
+            if task.assigned_to.name not in assistants:
+                raise ValueError(
+                    f"Task '{task.title}' is assigned to unknown assistant "
+                    + f"'{task.assigned_to.name}'."
+                )
+            for depend_on in task.depends_on:
+                if depend_on not in tasks:
+                    raise ValueError(
+                        f"Task '{task.title}' depends on unknown task '{depend_on}'."
                     )
+                self._dependents[depend_on].append(task.title)
+            indeg[task.title] = len(task.depends_on)
+
+        waves = []
+        wave = [task for task in self.tasks if indeg[task.title] == 0]
+
+        while wave:
+            waves.append(wave)
+            next_wave = []
+            for task in wave:
+                for child in self._dependents[task.title]:
+                    indeg[child] -= 1
+                    if indeg[child] == 0:
+                        next_wave.append(tasks[child])
+            wave = next_wave
+
+        cycle = [title for title, degree in indeg.items() if degree]
+        if cycle:
+            raise ValueError(f"Tasks have circular dependencies: {', '.join(cycle)}.")
+
+        return waves
+
+    async def _run_tasks(self, batch: list[Task], tasks: dict[str, Task]) -> None:
+        """
+        Run tasks of the same assistant in a single run, asking for a result per task.
+        Tasks missing from the response, or rejected batches, are run on their own.
+        """
+        if len(batch) == 1:
+            await self._run_task(batch[0], tasks)
+            return
+
+        async with self._semaphore:
+            for task in batch:
+                print(f"{task.assigned_to.role}: {task.instructions}")
+
+            depends_on = dict.fromkeys(
+                depend_on for task in batch for depend_on in task.depends_on
+            )
+            instructions = "\n\n".join(
+                f"custom_id: {task.title}\n{task.instructions}" for task in batch
+            )
+            messages = self._dependency_messages(depends_on, tasks)
+            messages.append(
+                {
+                    "role": "user",
+                    "content": "Complete each of the following tasks and respond "
+                    + "with the result of each task under its custom_id.\n\n"
+                    + instructions,
+                }
+            )
+
+            functions = sorted(
+                dict.fromkeys(function for task in batch for function in task.functions)
+            )
+            try:
+                text = await self._run_thread(
+                    messages,
+                    batch[0].assigned_to,
+                    functions,
+                    response_format=TASK_RESULTS_RESPONSE_FORMAT,
+                )
+            except BadRequestError as error:
+                print(f"Running tasks one at a time, batched run rejected: {error}")
+                text = None
+
+        try:
+            results = {
+                result["custom_id"]: result["result"]
+                for result in orjson.loads(text or "{}").get("results", [])
+            }
+        except orjson.JSONDecodeError:
+            results = {}
+
+        missing = []
+
+        for task in batch:
+            if task.title in results:
+                task.result = results[task.title]
+                print(f"{task.assigned_to.name}: {task.result}")
+                await self._complete_task(task)
+            else:
+                missing.append(task)
+
+        await asyncio.gather(*[self._run_task(task, tasks) for task in missing])
+
+    async def _run_task(self, task: Task, tasks: dict[str, Task]) -> None:
+        """Run a task on its own thread, seeded with the results of its dependencies."""
+        async with self._semaphore:
+            print(f"{task.assigned_to.role}: {task.instructions}")
+
+            messages = self._dependency_messages(task.depends_on, tasks)
+            messages.append({"role": "user", "content": task.instructions})
+
+            text = await self._run_thread(messages, task.assigned_to, task.functions)
+
+            if text:
+                task.result = text
+                print(f"{task.assigned_to.name}: {task.result}")
+
+        await self._complete_task(task)
+
+    async def _complete_task(self, task: Task) -> None:
+        """Mark a task as done, waiting for confirmation when interactive."""
+        if self._interactive:
+            async with self._input_lock:
+                await asyncio.to_thread(input, "> ")
+
+        task.done = True
+
+    def _dependency_messages(
+        self, depends_on: Iterable[str], tasks: dict[str, Task]
+    ) -> list[dict]:
+        """
+        Generate thread messages with the results of completed dependencies.
+        All ancestors are included, oldest first, as if the tasks shared a thread.
+        """
+        ancestors = {}
+
+        def visit(title: str) -> None:
+            if title in ancestors:
+                return
+            for parent in tasks[title].depends_on:
+                visit(parent)
+            ancestors[title] = tasks[title]
+
+        for depend_on in depends_on:
+            visit(depend_on)
+
+        return [
+            {
+                "role": "user",
+                "content": f"The task '{title}' has been completed "
+                + f"with this result: {task.result}",
+            }
+            for title, task in ancestors.items()
+            if task.result
+        ]
+
+    async def _run_thread(
+        self,
+        messages: list[dict],
+        assistant: Assistant,
+        functions: list[str],
+        response_format: Optional[dict] = None,
+    ) -> Optional[str]:
+        """Run an assistant on a new thread, returning the text of its last message."""
+        prompt = "\n".join(message["content"] for message in messages)
+
+        async with self._limiter.limit():
+            thread = await self._client.beta.threads.create(messages=messages)
+
+        params = {}
+        if response_format:
+            params["response_format"] = response_format
+
+        async with self._limiter.limit(prompt):
+            run, message = await self._stream_run(
+                self._client.beta.threads.runs.stream(
+                    thread_id=thread.id,
+                    assistant_id=assistant.id,
+                    tools=self.generate_tool_schemas(functions),
+                    **params,
+                )
+            )
+
+        while run.status == "requires_action":
+            tool_outputs = await self._call_tools(
+                run.required_action.submit_tool_outputs.tool_calls
+            )
 
-                    openai_assistant = self.get_openai_assistant(task.assigned_to)
+            outputs = "\n".join(output["output"] for output in tool_outputs)
 
-                    run = client.beta.threads.runs.create_and_poll(
+            async with self._limiter.limit(outputs):
+                run, message = await self._stream_run(
+                    self._client.beta.threads.runs.submit_tool_outputs_stream(
                         thread_id=thread.id,
-                        assistant_id=openai_assistant.id,
-                        tools=self.generate_tool_schemas(task.functions),
+                        run_id=run.id,
+                        tool_outputs=tool_outputs,
                     )
+                )
 
-                    while run.status == "requires_action":
-                        tool_outputs = []
-                        for (
-                            tool_call
-                        ) in run.required_action.submit_tool_outputs.tool_calls:
-                            tool_func = getattr(
-                                available_functions, tool_call.function.name
-                            )
-                            tool_arguments = json.loads(tool_call.function.arguments)
-
-                            print(
-                                f"Calling {tool_call.function.name} with {tool_arguments}"
-                            )
-                            output = tool_func(**tool_arguments)
-                            tool_outputs.append(
-                                {
-                                    "tool_call_id": tool_call.id,
-                                    "output": json.dumps(output),
-                                }
-                            )
-
-                        run = client.beta.threads.runs.submit_tool_outputs_and_poll(
-                            thread_id=thread.id,
-                            run_id=run.id,
-                            tool_outputs=tool_outputs,
-                        )
-
-                    messages = list(
-                        client.beta.threads.messages.list(
-                            thread_id=thread.id,
-                        )
-                    )
+        if run.status != "completed":
+            raise RuntimeError(
+                f"Run {run.id} ended with status {run.status}: {run.last_error}"
+            )
 
-                    most_recent_message = messages[0]
+        if message:
+            return message.content[0].text.value
 
-                    if most_recent_message.role == "assistant":
-                        print(
-                            f"{task.assigned_to.name}: {most_recent_message.content[0].text.value}"
-                        )
+        return None
 
-                    user_input = input("> ")
+    async def _stream_run(self, manager) -> tuple:
+        """Consume a run stream, returning the run and its last message."""
+        run = None
+        message = None
 
-                    task.done = True
-                    done_count += 1
+        async with manager as stream:
+            async for event in stream:
+                if event.event == "thread.message.completed":
+                    message = event.data
+                elif event.event in RUN_STOP_EVENTS:
+                    run = event.data
 
-    def generate_tool_schemas(self, functions: list[str]) -> list[dict]:
-        functions = [getattr(available_functions, f) for f in functions]
-        function_schemas = [FunctionCallFunctionSchema(f) for f in functions]
-        return [FunctionToolSchema(schema).to_dict() for schema in function_schemas]
-
-    def wait_on_run(self, run):
-        while run.status in ["queued", "in_progress"]:
-            run = self._client.beta.threads.runs.retrieve(
-                thread_id=run.thread_id,
-                run_id=run.id,
+        return run, message
+
+    async def _call_tools(self, tool_calls: list) -> list[dict]:
+        """Call the tools requested by a run concurrently."""
+        return list(
+            await asyncio.gather(
+                *[self._call_tool(tool_call) for tool_call in tool_calls]
             )
-            time.sleep(0.5)
-        return run
+        )
+
+    async def _call_tool(self, tool_call) -> dict:
+        """Call a tool, running synchronous functions in a worker thread."""
+        tool_func = getattr(available_functions, tool_call.function.name)
+        tool_arguments = orjson.loads(tool_call.function.arguments)
+
+        print(f"Calling {tool_call.function.name} with {tool_arguments}")
+
+        if inspect.iscoroutinefunction(tool_func):
+            output = await tool_func(**tool_arguments)
+        else:
+            output = await asyncio.to_thread(tool_func, **tool_arguments)
+
+        return {
+            "tool_call_id": tool_call.id,
+            "output": orjson.dumps(output).decode("utf-8"),
+        }
+
+    def generate_tool_schemas(self, functions: list[str]) -> list[dict]:
+        return list(_tool_schemas_for(tuple(sorted(functions))))
 
     @classmethod
     def load(cls, filename: str) -> "Project":
         """Load a project from a JSON file."""
-        with open(filename, "r", encoding="utf-8") as file:
-            data = json.load(file)
+        with open(filename, "rb") as file:
+            data = orjson.loads(file.read())
             return cls.model_validate(data)
 
     def save(self, filename: str) -> None:
         """Save the project to a JSON file."""
-        with open(filename, "w", encoding="utf-8") as file:
-            json.dump(self.model_dump(), file, indent=4)
+        with open(filename, "wb") as file:
+            file.write(orjson.dumps(self.model_dump(), option=orjson.OPT_INDENT_2))
 
-    def get_assistant_list(self) -> list:
+    async def get_assistant_list(self) -> list:
         """Get a list of OpenAI assistants."""
-        return self._client.beta.assistants.list()
+        return [
+            assistant
+            async for assistant in self._client.beta.assistants.list(limit=100)
+        ]
 
     def get_openai_assistant(self, assistant: Assistant) -> Optional[dict]:
         """Get an OpenAI assistant given an assistant model."""
-        name = self.generate_assistant_name(assistant)
-        return next(
-            (
-                assistant
-                for assistant in self.get_assistant_list()
-                if assistant.name == name
-            ),
-            None,
-        )
+        return self._assistant_index.get(self.generate_assistant_name(assistant))
 
     def generate_assistant_name(self, assistant: Assistant) -> str:
         """Generate an OpenAI assistant name given an assistant model."""
         return f"{self.reference}-{assistant.name}-{assistant.role}"
 
-    def update_or_create_assistant(self, assistant: Assistant) -> dict:
+    @retry(
+        retry=retry_if_exception_type(RateLimitError),
+        wait=wait_exponential_jitter(),
+        stop=stop_after_attempt(6),
+        reraise=True,
+    )
+    async def _aupsert(self, assistant: Assistant) -> dict:
+        """Update or create an assistant, bounded by the concurrency limit."""
+        async with self._semaphore:
+            print(
+                f"Creating/updating assistant {assistant.name} with role "
+                + f"{assistant.role} for project {self.reference}."
+            )
+            return await self.update_or_create_assistant(assistant)
+
+    async def update_or_create_assistant(self, assistant: Assistant) -> dict:
         """Update or create an OpenAI assistant given an assistant model."""
         name = self.generate_assistant_name(assistant)
 
@@ -199,9 +530,26 @@ class Project(BaseModel):
             "temperature": float(os.getenv("ASSISTANT_TEMPERATURE", "0.2")),
         }
 
-        openai_assistant = self.get_openai_assistant(assistant)
+        openai_assistant = None
+        openai_assistant_id = assistant.id
+
+        if not openai_assistant_id:
+            openai_assistant = self.get_openai_assistant(assistant)
+            openai_assistant_id = openai_assistant.id if openai_assistant else None
+
+        async with self._limiter.limit():
+            if openai_assistant_id:
+                try:
+                    openai_assistant = await self._client.beta.assistants.update(
+                        openai_assistant_id, **params
+                    )
+                except NotFoundError:
+                    openai_assistant = None
+
+            if not openai_assistant:
+                openai_assistant = await self._client.beta.assistants.create(**params)
 
-        if openai_assistant:
-            return self._client.beta.assistants.update(openai_assistant.id, **params)
+        assistant.id = openai_assistant.id
+        self._assistant_index[name] = openai_assistant
 
-        return self._client.beta.assistants.create(**params)
+        return openai_assistant
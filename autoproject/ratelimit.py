@@ -0,0 +1,60 @@
+import asyncio
+import os
+
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+import tiktoken
+
+from aiolimiter import AsyncLimiter
+
+# Prompts longer than this are tokenized in a worker thread
+THREADED_COUNT_LENGTH = 4096
+
+
+class RateLimiter:
+    """
+    Rate limiter that throttles OpenAI requests before they are sent.
+    Requests and tokens per minute are accounted for separately.
+    """
+
+    def __init__(
+        self, requests_per_minute: int, tokens_per_minute: int, model: str
+    ) -> None:
+        self.tokens_per_minute = tokens_per_minute
+        self._requests = AsyncLimiter(requests_per_minute, 60)
+        self._tokens = AsyncLimiter(tokens_per_minute, 60)
+
+        try:
+            self._encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            self._encoding = tiktoken.get_encoding("o200k_base")
+
+    @classmethod
+    def from_env(cls) -> "RateLimiter":
+        """Create a rate limiter from the environment."""
+        return cls(
+            requests_per_minute=int(os.getenv("OPENAI_REQUESTS_PER_MINUTE", "500")),
+            tokens_per_minute=int(os.getenv("OPENAI_TOKENS_PER_MINUTE", "30000")),
+            model=os.getenv("ASSISTANT_MODEL", "gpt-4o"),
+        )
+
+    def count_tokens(self, text: str) -> int:
+        """Estimate the number of tokens in a prompt."""
+        return len(self._encoding.encode_ordinary(text))
+
+    @asynccontextmanager
+    async def limit(self, text: str = "") -> AsyncIterator[None]:
+        """Wait for request and token capacity for a prompt."""
+        await self._requests.acquire()
+
+        if len(text) > THREADED_COUNT_LENGTH:
+            tokens = await asyncio.to_thread(self.count_tokens, text)
+        else:
+            tokens = self.count_tokens(text)
+
+        tokens = min(tokens, self.tokens_per_minute)
+        if tokens:
+            await self._tokens.acquire(tokens)
+
+        yield